@@ -1,4 +1,6 @@
 """Pollination Incident Radiation App."""
+import itertools
+
 import streamlit as st
 from pollination_streamlit_io import get_host
 
@@ -33,11 +35,8 @@ def main(platform):
     st.markdown("""---""")  # horizontal divider line between input and output
 
     # run the simulation
-    context_geo = []
-    if st.session_state.sim_context_geo is not None:
-        context_geo.extend(st.session_state.sim_context_geo)
-    if st.session_state.context_geo is not None:
-        context_geo.extend(st.session_state.context_geo)
+    context_geo = list(itertools.chain(
+        st.session_state.sim_context_geo or (), st.session_state.context_geo or ()))
     run_simulation(
         st.session_state.target_folder, st.session_state.user_id,
         st.session_state.sky_file_path, st.session_state.run_period,
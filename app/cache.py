@@ -0,0 +1,103 @@
+"""Functions for caching results on disk such that they are shared across sessions."""
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+try:
+    from importlib.metadata import version as _package_version
+except ImportError:  # python 3.7
+    from pkg_resources import get_distribution
+
+    def _package_version(name):
+        return get_distribution(name).version
+
+
+CACHE_VERSION = 1  # increment when the format of the cached files changes
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # size of each cache folder that triggers pruning
+
+
+def cache_file_path(cache_folder, prefix, extension, key, packages=()):
+    """Get the path to the file where data is cached from a text key of the data.
+
+    Args:
+        cache_folder: Path to the folder in which the cached file is written.
+        prefix: Text for the start of the file name.
+        extension: Text for the file extension (eg. '.npy').
+        key: Text that uniquely identifies the cached data.
+        packages: A list of package names whose installed version is included
+            in the key such that upgraded packages do not reuse old files.
+    """
+    versions = ','.join(
+        '{}={}'.format(pkg, _package_version(pkg)) for pkg in packages)
+    full_key = '{}|{}|{}'.format(CACHE_VERSION, versions, key)
+    digest = hashlib.blake2b(full_key.encode(), digest_size=16).hexdigest()
+    return Path(cache_folder, f'{prefix}_{digest}{extension}')
+
+
+def read_cache(cache_file, load):
+    """Read a cached file with a load function or get None if it cannot be read.
+
+    Files that fail to load are deleted such that they are recomputed and
+    the modification time of files that load is updated to track their use.
+    """
+    try:
+        data = load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception:  # truncated or corrupt file; recompute it
+        _remove_file(cache_file)
+        return None
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass  # the file was pruned by another session
+    return data
+
+
+def write_cache(cache_file, dump, max_bytes=CACHE_MAX_BYTES):
+    """Write data to a cached file using a dump function that accepts a file object.
+
+    The data is written to a temporary file that replaces the cached file once
+    it is complete such that other sessions never read a partial file. The
+    least recently used files are then removed if the cache folder exceeds
+    max_bytes.
+    """
+    cache_folder = cache_file.parent
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    temp_fd, temp_file = tempfile.mkstemp(dir=cache_folder, suffix='.tmp')
+    try:
+        with os.fdopen(temp_fd, 'wb') as cache_out:
+            dump(cache_out)
+        os.replace(temp_file, cache_file)
+    except BaseException:
+        _remove_file(temp_file)
+        raise
+    prune_cache(cache_folder, max_bytes)
+
+
+def prune_cache(cache_folder, max_bytes=CACHE_MAX_BYTES):
+    """Remove the least recently used files from a cache folder above max_bytes."""
+    cached = []
+    for entry in os.scandir(cache_folder):
+        if entry.name.endswith('.tmp') or not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # the file was removed by another session
+        cached.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total_size <= max_bytes:
+            break
+        _remove_file(path)
+        total_size -= size
+
+
+def _remove_file(path):
+    """Remove a file if it exists, ignoring files locked or removed by others."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
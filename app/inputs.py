@@ -1,16 +1,25 @@
 """Functions for initializing inputs and formatting them for simulation"""
 import uuid
 import json
+import shutil
+import pickle
+import hashlib
+import itertools
+import functools
 from pathlib import Path
 
+import numpy as np
 import streamlit as st
 
-from ladybug_geometry.geometry3d import Face3D, Mesh3D, Polyface3D
+from ladybug_geometry.geometry2d import Vector2D, Polygon2D, Mesh2D
+from ladybug_geometry.geometry3d import Point3D, Face3D, Mesh3D, Polyface3D
 from ladybug.analysisperiod import AnalysisPeriod
 from honeybee.model import Model
 
 from pollination_streamlit_io import get_hbjson, get_geometry, manage_settings
 
+from cache import cache_file_path, read_cache, write_cache
+
 GRID_SIZES = {
     'Meters': (1.0, 0.25),
     'Millimeters': (1000.0, 250.0),
@@ -20,62 +29,104 @@ GRID_SIZES = {
 }
 
 
-def initialize():
-    """Initialize any of the session state variables if they don't already exist."""
+SESSION_DEFAULTS = {
     # user session
-    if 'user_id' not in st.session_state:
-        st.session_state.user_id = str(uuid.uuid4())[:8]
-    if 'target_folder' not in st.session_state:
-        st.session_state.target_folder = Path(__file__).parent
+    'user_id': lambda: str(uuid.uuid4())[:8],
+    'target_folder': lambda: Path(__file__).parent,
     # sky sim session
-    if 'sky_file_path' not in st.session_state:
-        st.session_state.sky_file_path = None
-    if 'north' not in st.session_state:
-        st.session_state.north = 0
-    if 'high_sky_density' not in st.session_state:
-        st.session_state.high_sky_density = False
-    if 'average_irradiance' not in st.session_state:
-        st.session_state.average_irradiance = False
-    if 'use_benefit' not in st.session_state:
-        st.session_state.use_benefit = False
-    if 'balance_temperature' not in st.session_state:
-        st.session_state.balance_temperature = 16.0
-    if 'run_period' not in st.session_state:
-        st.session_state.run_period = AnalysisPeriod()
-    if 'sky_matrix' not in st.session_state:
-        st.session_state.sky_matrix = None
+    'sky_file_path': None,
+    'weather_file_id': None,
+    'north': 0,
+    'high_sky_density': False,
+    'average_irradiance': False,
+    'use_benefit': False,
+    'balance_temperature': 16.0,
+    'run_period': AnalysisPeriod,
+    'run_period_inputs': None,
+    'sky_matrix': None,
     # intersection sim session
-    if 'simulation_geo' not in st.session_state:
-        st.session_state.simulation_geo = None
-    if 'sim_context_geo' not in st.session_state:
-        st.session_state.sim_context_geo = None
-    if 'context_geo' not in st.session_state:
-        st.session_state.context_geo = None
-    if 'hb_model' not in st.session_state:  # used only in web and revit
-        st.session_state.hb_model = None
-    if 'ground_reflectance' not in st.session_state:
-        st.session_state.ground_reflectance = 0.2
-    if 'grid_size' not in st.session_state:  # used only in rhino and sketchup
-        st.session_state.grid_size = 1.0
-    if 'offset_distance' not in st.session_state:  # used only in rhino and sketchup
-        st.session_state.offset_distance = 0
-    if 'unit_system' not in st.session_state:  # used only in rhino and sketchup
-        st.session_state.unit_system = 'Meters'
-    if 'intersection_matrix' not in st.session_state:
-        st.session_state.intersection_matrix = None
+    'simulation_geo': None,
+    'sim_context_geo': None,
+    'decoded_geometry_data': None,  # used only in rhino and sketchup
+    'decoded_geometry': None,  # used only in rhino and sketchup
+    'context_geo': None,
+    'model_hash': None,  # used only in web and revit
+    'geometry_cache_file': None,  # used only in rhino and sketchup
+    'context_hash': None,  # used only in rhino and sketchup
+    'processed_inputs': set,  # keys of the inputs processed on the current run
+    'hb_model': None,  # used only in web and revit
+    'ground_reflectance': 0.2,
+    'grid_size': 1.0,  # used only in rhino and sketchup
+    'offset_distance': 0,  # used only in rhino and sketchup
+    'unit_system': 'Meters',  # used only in rhino and sketchup
+    'intersection_matrix': None,
+    'int_ground_sum': None,
+    'face_areas': None,
     # output session
-    if 'override_min_max' not in st.session_state:
-        st.session_state.override_min_max = False
-    if 'legend_min' not in st.session_state:
-        st.session_state.legend_min = 0.0
-    if 'legend_max' not in st.session_state:
-        st.session_state.legend_max = 100.0
-    if 'legend_seg_count' not in st.session_state:
-        st.session_state.legend_seg_count = 11
-    if 'radiation_values' not in st.session_state:
-        st.session_state.radiation_values = None
-    if 'vtk_path' not in st.session_state:
-        st.session_state.vtk_path = None
+    'override_min_max': False,
+    'legend_min': 0.0,
+    'legend_max': 100.0,
+    'legend_seg_count': 11,
+    'radiation_values': None,
+    'viz_set': None,
+    'vtk_bytes': None
+}  # callables are only called when the session state variable does not exist
+
+
+GEOMETRY_TYPES = {
+    'Face3D': Face3D,
+    'Mesh3D': Mesh3D,
+    'Polyface3D': Polyface3D
+}
+
+
+def initialize():
+    """Initialize any of the session state variables if they don't already exist."""
+    for key, default in SESSION_DEFAULTS.items():
+        if key not in st.session_state:
+            st.session_state[key] = default() if callable(default) else default
+
+
+def compact_json(data):
+    """Get a compact JSON string of data with sorted keys for hashing and caching.
+
+    The data loaded from the CAD environment are never circular so the check
+    for circular references is skipped to speed up the serialization.
+    """
+    return json.dumps(data, sort_keys=True, separators=(',', ':'),
+                      check_circular=False)
+
+
+def join_meshes(meshes):
+    """Join a list of Mesh3D into a single Mesh3D.
+
+    This is faster than Mesh3D.join_meshes for the large numbers of grid meshes
+    used by this app since the face indices are offset without a generator per
+    face. Mesh colors are not carried over to the joined mesh.
+    """
+    verts, faces = [], []
+    for mesh in meshes:
+        st_i = len(verts)
+        if st_i == 0:
+            faces.extend(mesh.faces)
+        else:
+            faces.extend([
+                (f[0] + st_i, f[1] + st_i, f[2] + st_i) if len(f) == 3 else
+                (f[0] + st_i, f[1] + st_i, f[2] + st_i, f[3] + st_i)
+                for f in mesh.faces
+            ])
+        verts.extend(mesh.vertices)
+    return Mesh3D(verts, faces)
+
+
+def new_intersection_matrix():
+    """Reset all of the state variables related to the intersection matrix."""
+    # reset the simulation results
+    st.session_state.intersection_matrix = None
+    st.session_state.int_ground_sum = None
+    st.session_state.radiation_values = None
+    st.session_state.viz_set = None
+    st.session_state.vtk_bytes = None
 
 
 def new_sky_matrix():
@@ -83,24 +134,49 @@ def new_sky_matrix():
     # reset the simulation results
     st.session_state.sky_matrix = None
     st.session_state.radiation_values = None
-    st.session_state.vtk_path = None
+    st.session_state.viz_set = None
+    st.session_state.vtk_bytes = None
+
+
+def new_legend():
+    """Reset the visualization of the results for new legend parameters."""
+    # the results are the same and only need to be displayed with the new legend
+    st.session_state.viz_set = None
+    st.session_state.vtk_bytes = None
 
 
 def new_sky_file():
     """Process a newly-uploaded EPW file."""
-    new_sky_matrix()
     weather_file = st.session_state.weather_data
     if weather_file:
-        # save EPW in data folder
+        # check whether the file is the same as the one that is already loaded
+        with weather_file.getbuffer() as file_buffer:
+            digest = hashlib.sha256(file_buffer).hexdigest()
+        file_id = (weather_file.name, digest)
+        if file_id == st.session_state.weather_file_id and \
+                st.session_state.sky_file_path is not None:
+            return
+        new_sky_matrix()
+        # save EPW in data folder, keeping only the file name sent by the client
         epw_path = Path(
-            f'./{st.session_state.target_folder}/data/'
-            f'{st.session_state.user_id}/{weather_file.name}'
-        )
+            st.session_state.target_folder, 'data', st.session_state.user_id,
+            Path(weather_file.name).name)
         epw_path.parent.mkdir(parents=True, exist_ok=True)
-        epw_path.write_bytes(weather_file.read())
+        weather_file.seek(0)  # the upload may have been read on a previous run
+        with epw_path.open('wb') as epw_file:
+            shutil.copyfileobj(weather_file, epw_file, length=1 << 20)
         st.session_state.sky_file_path = epw_path
+        st.session_state.weather_file_id = file_id
     else:
+        new_sky_matrix()
         st.session_state.sky_file_path = None
+        st.session_state.weather_file_id = None
+
+
+def new_sky_density():
+    """Reset the sky matrix and the intersection matrix for a new sky density."""
+    new_sky_matrix()
+    new_intersection_matrix()
 
 
 def get_sky_file(column):
@@ -114,27 +190,51 @@ def get_sky_file(column):
     )
 
 
+@st.experimental_singleton(show_spinner=False, max_entries=4)
+def _parse_model(model_hash, _hbjson_data):
+    """Parse Honeybee Model data into the Model, study mesh, areas and context.
+
+    The result is cached using the model_hash such that the same Model data
+    is not re-parsed every time that it is loaded into the app.
+    """
+    hb_model = Model.from_dict(_hbjson_data)
+    geo_meshes = [sg.mesh for sg in hb_model.properties.radiance.sensor_grids
+                  if sg.mesh is not None]
+    if len(geo_meshes) == 0:
+        raise ValueError(
+            'Model contains no sensor grids with meshes. '
+            'Sensor grids with meshes are required to use this app.')
+    simulation_geo = join_meshes(geo_meshes)
+    face_areas = np.array(simulation_geo.face_areas, dtype=np.float64)
+    face_areas.flags.writeable = False  # the array is shared between sessions
+    context_geo = list(itertools.chain(
+        (obj.punched_geometry for obj in hb_model.faces),
+        (obj.geometry for obj in hb_model.shades)))
+    return hb_model, simulation_geo, face_areas, context_geo
+
+
 def new_model():
     """Process a newly-uploaded Honeybee Model file."""
-    # reset the simulation results and get the file data
-    st.session_state.intersection_matrix = None
-    st.session_state.radiation_values = None
-    st.session_state.vtk_path = None
+    state = st.session_state
+    state.processed_inputs.add('hbjson_data')
     # load the model object from the file data
-    if 'hbjson' in st.session_state['hbjson_data']:
-        hbjson_data = st.session_state['hbjson_data']['hbjson']
-        hb_model = Model.from_dict(hbjson_data)
-        st.session_state.hb_model = hb_model
-        geo_meshes = [sg.mesh for sg in hb_model.properties.radiance.sensor_grids
-                      if sg.mesh is not None]
-        if len(geo_meshes) == 0:
-            raise ValueError(
-                'Model contains no sensor grids with meshes. '
-                'Sensor grids with meshes are required to use this app.')
-        st.session_state.simulation_geo = Mesh3D.join_meshes(geo_meshes)
-        st.session_state.context_geo = \
-            [obj.punched_geometry for obj in hb_model.faces] + \
-            [obj.geometry for obj in hb_model.shades]
+    if 'hbjson' in state['hbjson_data']:
+        hbjson_data = state['hbjson_data']['hbjson']
+        model_hash = hashlib.sha256(
+            compact_json(hbjson_data).encode()).hexdigest()
+        if model_hash == state.model_hash and state.simulation_geo is not None:
+            return  # the same model is already loaded
+        # reset the simulation results
+        new_intersection_matrix()
+        hb_model, simulation_geo, face_areas, context_geo = \
+            _parse_model(model_hash, hbjson_data)
+        state.hb_model = hb_model
+        state.simulation_geo = simulation_geo
+        state.face_areas = face_areas
+        state.context_geo = context_geo
+        state.model_hash = model_hash
+    else:
+        new_intersection_matrix()
 
 
 def get_model(column):
@@ -143,56 +243,249 @@ def get_model(column):
     with column:
         hbjson_data = get_hbjson(key='hbjson_data', on_change=new_model)
     if st.session_state.simulation_geo is None and hbjson_data is not None \
-            and 'hbjson' in hbjson_data:
+            and 'hbjson' in hbjson_data \
+            and 'hbjson_data' not in st.session_state.processed_inputs:
         new_model()
 
 
+def _points_inside_polygon(polygon, points, test_vector=(1, 0.00001)):
+    """Get a list of booleans for whether Point2Ds lie inside a Polygon2D.
+
+    This is a vectorized version of Polygon2D.is_point_inside, which counts the
+    intersections of a test ray from each point with the polygon edges.
+    """
+    poly_pts = np.array([(pt.x, pt.y) for pt in polygon.vertices])
+    seg_vecs = np.roll(poly_pts, -1, axis=0) - poly_pts
+    vx, vy = test_vector
+    d = vy * seg_vecs[:, 0] - vx * seg_vecs[:, 1]
+    not_parallel = d != 0
+    poly_pts, seg_vecs, d = poly_pts[not_parallel], seg_vecs[not_parallel], \
+        d[not_parallel]
+    pts = np.array([(pt.x, pt.y) for pt in points])
+    inside = []
+    step = max(1, 2 ** 20 // max(1, len(d)))  # limit the memory of each block
+    for i in range(0, len(pts), step):
+        block = pts[i:i + step]
+        dy = poly_pts[:, 1] - block[:, 1:2]
+        dx = poly_pts[:, 0] - block[:, 0:1]
+        ua = (vx * dy - vy * dx) / d
+        ub = (seg_vecs[:, 0] * dy - seg_vecs[:, 1] * dx) / d
+        n_int = np.count_nonzero((ua >= 0) & (ua <= 1) & (ub >= 0), axis=1)
+        inside.extend((n_int % 2 == 1).tolist())
+    return inside
+
+
+def _plane_points_to_3d(plane, points):
+    """Get a tuple of Point3D from Point2Ds in the coordinate system of a plane."""
+    pts = np.array([(pt.x, pt.y) for pt in points])
+    o, x, y = plane.o, plane.x, plane.y
+    pts_3d = zip(
+        (o.x + x.x * pts[:, 0] + y.x * pts[:, 1]).tolist(),
+        (o.y + x.y * pts[:, 0] + y.y * pts[:, 1]).tolist(),
+        (o.z + x.z * pts[:, 0] + y.z * pts[:, 1]).tolist()
+    )
+    return tuple(Point3D(*pt) for pt in pts_3d)
+
+
+def mesh_grid(face, grid_size):
+    """Get a gridded Mesh3D over a Face3D.
+
+    This produces the same result as Face3D.mesh_grid(grid_size) but the testing
+    of grid points inside the face and the conversion of the grid to 3D are
+    done with NumPy, making it several times faster.
+    """
+    # generate a grid over the face polygon using the same method as Mesh2D
+    polygon = face.polygon2d
+    x_dim, num_x = Mesh2D._domain_dimensions(polygon.max.x - polygon.min.x, grid_size)
+    y_dim, num_y = Mesh2D._domain_dimensions(polygon.max.y - polygon.min.y, grid_size)
+    poly_min = polygon.min
+    verts = Mesh2D._grid_vertices(poly_min, num_x, num_y, x_dim, y_dim)
+    faces = Mesh2D._grid_faces(num_x, num_y)
+    centroids = Mesh2D._grid_centroids(poly_min, num_x, num_y, x_dim, y_dim)
+
+    # remove the vertices outside of a slightly scaled polygon like Mesh2D does
+    tol_pt = Vector2D(0.0000001, 0.0000001)
+    scaled_poly = Polygon2D(
+        tuple(pt.scale(1.000001, poly_min) - tol_pt for pt in polygon.vertices))
+    pattern = _points_inside_polygon(scaled_poly, verts)
+    grid_mesh2d = Mesh2D(verts, faces)
+    grid_mesh2d._face_centroids = centroids
+    grid_mesh2d._face_area_centroids = centroids
+    grid_mesh2d, _ = grid_mesh2d.remove_vertices(pattern)
+
+    # convert the 2D mesh into a 3D mesh in the plane of the face
+    plane = face.plane
+    grid_mesh3d = Mesh3D(_plane_points_to_3d(plane, grid_mesh2d.vertices),
+                         grid_mesh2d.faces)
+    grid_mesh3d._face_areas = grid_size * grid_size
+    grid_mesh3d._face_normals = plane.n
+    grid_mesh3d._vertex_normals = plane.n
+    grid_mesh3d._face_centroids = \
+        _plane_points_to_3d(plane, grid_mesh2d.face_centroids)
+    return grid_mesh3d
+
+
+@functools.lru_cache(maxsize=None)
+def _mesh_grid_matches():
+    """Check once that mesh_grid gives the same result as Face3D.mesh_grid.
+
+    mesh_grid uses private methods of ladybug_geometry and so this check makes
+    sure that Face3D.mesh_grid is used if they change in an installed version.
+    """
+    boundary = (Point3D(0, 0, 0), Point3D(6, 0, 0), Point3D(6, 3, 1),
+                Point3D(3, 3, 1), Point3D(3, 6, 2), Point3D(0, 6, 2))
+    hole = (Point3D(1, 1, 0.333333), Point3D(2, 1, 0.333333),
+            Point3D(2, 2, 0.666667), Point3D(1, 2, 0.666667))
+    face = Face3D(boundary, holes=[hole])
+    try:
+        fast_mesh, lb_mesh = mesh_grid(face, 0.5), face.mesh_grid(0.5)
+    except AttributeError:
+        return False
+    return fast_mesh.faces == lb_mesh.faces and all(
+        fast_pt.is_equivalent(lb_pt, 1e-6) for fast_pt, lb_pt in zip(
+            fast_mesh.vertices + fast_mesh.face_centroids,
+            lb_mesh.vertices + lb_mesh.face_centroids))
+
+
+def _mesh_grid_face(face, grid_size):
+    """Get a Mesh3D grid from a Face3D or None if the grid size is not small enough.
+    """
+    try:
+        if _mesh_grid_matches():
+            try:
+                return mesh_grid(face, grid_size)
+            except AttributeError:  # private ladybug_geometry methods changed
+                pass
+        return face.mesh_grid(grid_size)
+    except AssertionError:
+        return None  # grid size is not small enough
+
+
+def mesh_grid_faces(faces, grid_size):
+    """Get a list of Mesh3D grids (or None) from a list of Face3D."""
+    return [_mesh_grid_face(face, grid_size) for face in faces]
+
+
+def _add_face3d(face, geo_face3d, geo_meshes, mesh_faces):
+    """Add a decoded Face3D to the lists of study geometry."""
+    geo_face3d.append(face)
+    mesh_faces.append(face)
+
+
+def _add_mesh3d(mesh, geo_face3d, geo_meshes, mesh_faces):
+    """Add a decoded Mesh3D to the lists of study geometry."""
+    geo_face3d.append(mesh)
+    geo_meshes.append(mesh)
+
+
+def _add_polyface3d(polyface, geo_face3d, geo_meshes, mesh_faces):
+    """Add the faces of a decoded Polyface3D to the lists of study geometry."""
+    geo_face3d.extend(polyface.faces)
+    mesh_faces.extend(polyface.faces)
+
+
+_GEOMETRY_BUILDERS = {
+    'Face3D': _add_face3d,
+    'Mesh3D': _add_mesh3d,
+    'Polyface3D': _add_polyface3d
+}
+
+
+def iter_geometry_dicts(geo_data):
+    """Iterate over the geometry dictionaries of data loaded from the CAD environment.
+
+    The data is a list where each item is either a geometry dictionary or a list
+    of geometry dictionaries (eg. the Face3Ds of a Brep).
+    """
+    for geo in geo_data:
+        if isinstance(geo, (list, tuple)):
+            yield from geo
+        else:
+            yield geo
+
+
+def decode_geometry(geo_data):
+    """Decode the geometry dictionaries that are loaded from the CAD environment.
+
+    Returns:
+        A tuple with three elements.
+
+        -   geo_face3d: A list of all Face3D and Mesh3D in the geometry.
+
+        -   geo_meshes: A list of the Mesh3D in the geometry.
+
+        -   mesh_faces: A list of the Face3D in the geometry, which must be
+            meshed in order to be used as study geometry.
+    """
+    geo_face3d, geo_meshes, mesh_faces = [], [], []
+    for geo_dict in iter_geometry_dicts(geo_data):
+        builder = _GEOMETRY_BUILDERS.get(geo_dict['type'])
+        if builder is not None:
+            geometry = GEOMETRY_TYPES[geo_dict['type']].from_dict(geo_dict)
+            builder(geometry, geo_face3d, geo_meshes, mesh_faces)
+    return geo_face3d, geo_meshes, mesh_faces
+
+
+def _geometry_cache_file(geo_data, grid_size):
+    """Get the path to the file where the meshed study geometry is cached."""
+    geo_json = compact_json([geo_data, round(float(grid_size), 6)])
+    cache_folder = Path(st.session_state.target_folder, 'data', 'geometry')
+    return cache_file_path(cache_folder, 'geo', '.pkl', geo_json, ('ladybug-geometry',))
+
+
 def new_geometry():
     """Process a newly-loaded geometry."""
-    # reset the simulation results and get the file data
-    st.session_state.intersection_matrix = None
-    st.session_state.radiation_values = None
-    st.session_state.vtk_path = None
+    state = st.session_state
+    state.processed_inputs.add('geometry_data')
     # load the model object from the file data
-    if st.session_state['geometry_data'] is not None and \
-            'geometry' in st.session_state['geometry_data']:
-        geo_data = st.session_state['geometry_data']['geometry']
+    if state['geometry_data'] is not None and 'geometry' in state['geometry_data']:
+        geo_data = state['geometry_data']['geometry']
         if geo_data is None:
-            st.session_state.simulation_geo = None
+            new_intersection_matrix()
+            state.simulation_geo = None
+            state.face_areas = None
+            return
+        # skip the geometry if it is already meshed at the same grid size
+        grid_size = state.grid_size
+        cache_file = _geometry_cache_file(geo_data, grid_size)
+        if cache_file == state.geometry_cache_file and \
+                state.simulation_geo is not None:
             return
-        grid_size = st.session_state.grid_size
-        geo_meshes, geo_face3d = [], []
-        for geo in geo_data:
-            if isinstance(geo, (list, tuple)):
-                for geo_dict in geo:
-                    if geo_dict['type'] == 'Face3D':
-                        face = Face3D.from_dict(geo_dict)
-                        geo_face3d.append(face)
-                        try:
-                            geo_meshes.append(face.mesh_grid(grid_size))
-                        except AssertionError:
-                            pass  # grid size is not small enough
-            elif geo_dict['type'] == 'Mesh3D':
-                mesh = Mesh3D.from_dict(geo_dict)
-                geo_meshes.append(mesh)
-                geo_face3d.append(mesh)
-            elif geo_dict['type'] == 'Polyface3D':
-                polyface = Polyface3D.from_dict(geo_dict)
-                for face in polyface.faces:
-                    geo_face3d.append(face)
-                    try:
-                        geo_meshes.append(face.mesh_grid(grid_size))
-                    except AssertionError:
-                        pass  # grid size is not small enough
+        # reset the simulation results
+        new_intersection_matrix()
+        state.geometry_cache_file = cache_file
+        # load the meshed geometry if it has already been meshed in any session
+        cached_geo = read_cache(cache_file, lambda path: pickle.loads(path.read_bytes()))
+        if cached_geo is not None:
+            state.simulation_geo, state.sim_context_geo = cached_geo
+            state.face_areas = np.array(state.simulation_geo.face_areas)
+            return
+        # decode the geometry objects unless they are already decoded
+        if geo_data is not state.decoded_geometry_data:
+            state.decoded_geometry = decode_geometry(geo_data)
+            state.decoded_geometry_data = geo_data
+        geo_face3d, study_meshes, mesh_faces = state.decoded_geometry
+        # mesh the faces of the geometry using the grid size
+        geo_meshes = list(study_meshes)
+        face_meshes = mesh_grid_faces(mesh_faces, grid_size)
+        geo_meshes.extend(mesh for mesh in face_meshes if mesh is not None)
         if len(geo_meshes) != 0:
-            st.session_state.simulation_geo = Mesh3D.join_meshes(geo_meshes)
-            st.session_state.sim_context_geo = geo_face3d
+            simulation_geo = join_meshes(geo_meshes)
+            state.simulation_geo = simulation_geo
+            state.face_areas = np.array(simulation_geo.face_areas)  # before pickling
+            state.sim_context_geo = geo_face3d
+            # write the meshed geometry to the cache for use in future sessions
+            write_cache(cache_file, lambda cache_out: pickle.dump(
+                (simulation_geo, geo_face3d), cache_out, pickle.HIGHEST_PROTOCOL))
         else:
-            st.session_state.simulation_geo = None
-            st.session_state.sim_context_geo = None
+            state.simulation_geo = None
+            state.face_areas = None
+            state.sim_context_geo = None
             msg = 'Failed to mesh the geometry at the specified grid size.\n' \
                 'Try lowering the grid size.'
             st.write(msg)
+    else:
+        new_intersection_matrix()
 
 
 def get_study_geometry(column):
@@ -213,37 +506,33 @@ def get_study_geometry(column):
             geometry_data = get_geometry(
                 key='geometry_data', on_change=new_geometry, label='Geometry')
     if st.session_state.simulation_geo is None and geometry_data is not None \
-            and 'geometry' in geometry_data:
+            and 'geometry' in geometry_data \
+            and 'geometry_data' not in st.session_state.processed_inputs:
         new_geometry()
 
 
 def new_context():
     """Process a newly-loaded context geometry."""
-    # reset the simulation results and get the file data
-    st.session_state.intersection_matrix = None
-    st.session_state.radiation_values = None
-    st.session_state.vtk_path = None
+    state = st.session_state
+    state.processed_inputs.add('context_data')
     # load the model object from the file data
-    if 'geometry' in st.session_state['context_data']:
-        geo_data = st.session_state['context_data']['geometry']
+    if 'geometry' in state['context_data']:
+        geo_data = state['context_data']['geometry']
         if geo_data is None:
-            st.session_state.simulation_geo = None
+            new_intersection_matrix()
+            state.simulation_geo = None
+            state.face_areas = None
             return
-        geo_objs = []
-        for geo in geo_data:
-            if isinstance(geo, (list, tuple)):
-                for geo_dict in geo:
-                    if geo_dict['type'] == 'Face3D':
-                        face = Face3D.from_dict(geo_dict)
-                        geo_objs.append(face)
-            elif geo['type'] == 'Mesh3D':
-                mesh = Mesh3D.from_dict(geo)
-                geo_objs.append(mesh)
-            elif geo['type'] == 'Polyface3D':
-                polyface = Polyface3D.from_dict(geo)
-                for face in polyface.faces:
-                    geo_objs.append(face)
-        st.session_state.context_geo = geo_objs
+        context_hash = hashlib.blake2b(
+            compact_json(geo_data).encode(), digest_size=16).hexdigest()
+        if context_hash == state.context_hash and state.context_geo is not None:
+            return  # the same context is already loaded
+        # reset the simulation results
+        new_intersection_matrix()
+        state.context_geo, _, _ = decode_geometry(geo_data)
+        state.context_hash = context_hash
+    else:
+        new_intersection_matrix()
 
 
 def get_context_geometry(column):
@@ -264,10 +553,21 @@ def get_context_geometry(column):
             context_data = get_geometry(
                 key='context_data', on_change=new_context, label='Context')
     if st.session_state.context_geo is None and context_data is not None \
-            and 'geometry' in context_data:
+            and 'geometry' in context_data \
+            and 'context_data' not in st.session_state.processed_inputs:
         new_context()
 
 
+def _analysis_period(*period_inputs):
+    """Get an AnalysisPeriod from inputs, reusing the run period if they are unchanged.
+    """
+    if period_inputs == st.session_state.run_period_inputs:
+        return st.session_state.run_period
+    run_period = AnalysisPeriod(*period_inputs)  # raise on invalid inputs every run
+    st.session_state.run_period_inputs = period_inputs
+    return run_period
+
+
 def get_run_period(container):
     """Get a run period from user input."""
     pit_help = 'Check to have the radiation calculation run for only a single '\
@@ -281,7 +581,7 @@ def get_run_period(container):
                 label='Day', min_value=1, max_value=31, value=21)
             in_hour = dt_col_3.number_input(
                 label='Hour', min_value=0, max_value=23, value=12)
-            return AnalysisPeriod(in_month, in_day, in_hour, in_month, in_day, in_hour)
+            return _analysis_period(in_month, in_day, in_hour, in_month, in_day, in_hour)
         else:
             dt_col_1, dt_col_2, dt_col_3 = container.columns(3)
             dt_col_4, dt_col_5, dt_col_6 = container.columns(3)
@@ -297,8 +597,8 @@ def get_run_period(container):
                 label='End Day', min_value=1, max_value=31, value=31)
             end_hour = dt_col_6.number_input(
                 label='End Hour', min_value=0, max_value=23, value=23)
-            return AnalysisPeriod(st_month, st_day, st_hour,
-                                  end_month, end_day, end_hour)
+            return _analysis_period(st_month, st_day, st_hour,
+                                    end_month, end_day, end_hour)
 
 
 def get_inputs(host: str, container):
@@ -311,20 +611,19 @@ def get_inputs(host: str, container):
         if settings_dict is not None:
             if isinstance(settings_dict, str):
                 settings_dict = json.loads(settings_dict)
-            st.session_state.unit_system = settings_dict['units']
-            g_size, g_step = GRID_SIZES[st.session_state.unit_system]
-        else:
-            g_size, g_step = GRID_SIZES['Meters']
+            if settings_dict['units'] != st.session_state.unit_system:
+                # reset the grid size to the default for the new units
+                st.session_state.unit_system = settings_dict['units']
+                st.session_state.grid_size = GRID_SIZES[settings_dict['units']][0]
+                new_geometry()
+        g_size, g_step = GRID_SIZES[st.session_state.unit_system]
         # create an input component for the grid size
         grid_help = 'Number in model units for the size of grid cells at which ' \
             'the input Geometry will be subdivided. The smaller the grid size, ' \
             'the higher the resolution and the longer the calculation will take.'
-        in_grid_size = m_col_last.number_input(
-            label='Grid Size', min_value=0.001,
-            value=g_size, step=g_step, help=grid_help)
-        if in_grid_size != st.session_state.grid_size:
-            st.session_state.grid_size = in_grid_size
-            new_geometry()
+        m_col_last.number_input(
+            label='Grid Size', min_value=0.001, step=g_step, help=grid_help,
+            key='grid_size', on_change=new_geometry)
         # create an input component for the offset distance
         off_help = 'Number in model units for the distance to move points from ' \
             'the surfaces of the input geometry.'
@@ -333,26 +632,22 @@ def get_inputs(host: str, container):
             value=g_size, step=g_step, help=off_help)
         if in_off_dist != st.session_state.offset_distance:
             st.session_state.offset_distance = in_off_dist
-            st.session_state.intersection_matrix = None
-            st.session_state.radiation_values = None
-            st.session_state.vtk_path = None
+            new_intersection_matrix()
         # add buttons to get the geometry and context
         get_study_geometry(m_col_1)
         get_context_geometry(m_col_2)
     else:
         m_col_1, m_col_last = container.columns([2, 1])
         get_model(m_col_1)
+    st.session_state.processed_inputs.clear()  # process them again on the next run
 
     # get the input ground reflectance
     ref_help = 'Number between 0 and 1 for the average ground reflectance. This is ' \
         'used to build an emissive ground hemisphere that influences points with an ' \
         'unobstructed view to the ground.'
-    in_g_ref = m_col_last.number_input(
-        label='Ground Reflectance', min_value=0.0, max_value=1.0, value=0.2,
-        step=0.05, help=ref_help)
-    if in_g_ref != st.session_state.ground_reflectance:
-        st.session_state.ground_reflectance = in_g_ref
-        new_sky_matrix()
+    m_col_last.number_input(
+        label='Ground Reflectance', min_value=0.0, max_value=1.0, step=0.05,
+        help=ref_help, key='ground_reflectance', on_change=new_sky_matrix)
 
     # get the input file to generate the sky
     w_col_1, w_col_2 = container.columns([2, 1])
@@ -361,22 +656,16 @@ def get_inputs(host: str, container):
     # set up inputs for sky density, north and type of output metric
     north_help = 'Number between -360 and 360 for the counterclockwise difference ' \
         'between the North and the positive Y-axis in degrees. 90 is West; 270 is East.'
-    in_north = w_col_2.number_input(
-        label='North', min_value=-360, max_value=360, value=0, help=north_help)
-    if in_north != st.session_state.north:
-        st.session_state.north = in_north
-        st.session_state.intersection_matrix = None
-        st.session_state.radiation_values = None  # reset to have results recomputed
-        st.session_state.vtk_path = None  # reset to have results recomputed
+    w_col_2.number_input(
+        label='North', min_value=-360, max_value=360, help=north_help,
+        key='north', on_change=new_intersection_matrix)
     den_help = 'Check to use a higher-density Reinhart sky matrix, which has ' \
         'roughly 4 times the sky patches as the default Tregenza sky. ' \
         'Note that, while the Reinhart sky has a higher resolution and is ' \
         'more accurate, it will result in considerably longer calculation time.'
-    sky_density = w_col_2.checkbox(label='High Density Sky', value=False, help=den_help)
-    if sky_density != st.session_state.high_sky_density:
-        st.session_state.high_sky_density = sky_density
-        new_sky_matrix()
-        st.session_state.intersection_matrix = None
+    w_col_2.checkbox(
+        label='High Density Sky', help=den_help,
+        key='high_sky_density', on_change=new_sky_density)
     irr_help = 'Check to display the radiation results in units of average irradiance ' \
         '(W/m2) over the time period instead of units of cumulative radiation (kWh/m2).'
     avg_irradiance = w_col_2.checkbox(
@@ -394,7 +683,7 @@ def get_inputs(host: str, container):
         if use_benefit != st.session_state.use_benefit:
             st.session_state.use_benefit = use_benefit
             new_sky_matrix()
-            st.session_state.intersection_matrix = None
+            new_intersection_matrix()
         if use_benefit:
             bal_help = 'Number for the balance temperature in (C) around which ' \
                 'radiation switches from being helpful to harmful. Hours where the '\
@@ -408,7 +697,7 @@ def get_inputs(host: str, container):
             if in_bal_temp != st.session_state.balance_temperature:
                 st.session_state.balance_temperature = in_bal_temp
                 new_sky_matrix()
-                st.session_state.intersection_matrix = None
+                new_intersection_matrix()
 
     # set up the inputs for the date range
     container.markdown("""---""")  # horizontal divider between datetimes and others
@@ -416,27 +705,29 @@ def get_inputs(host: str, container):
     if in_run_period != st.session_state.run_period:
         st.session_state.run_period = in_run_period
         new_sky_matrix()
-        st.session_state.vtk_path = None  # reset to have results recomputed
+        st.session_state.vtk_bytes = None  # reset to have results recomputed
 
     # set up the side panel inputs to customize the legend
     over_min_max = st.sidebar.checkbox(
         label='Override Min and Max', value=False)
     if over_min_max != st.session_state.override_min_max:
         st.session_state.override_min_max = over_min_max
-        new_sky_matrix()
+        new_legend()
     disable_min_max = False if over_min_max else True
-    in_leg_min = st.sidebar.number_input(
-        label='Legend Min', value=0.0, step=10.0, disabled=disable_min_max)
+    with st.sidebar.form(key='legend'):  # only rerun once all values are set
+        in_leg_min = st.number_input(
+            label='Legend Min', value=0.0, step=10.0, disabled=disable_min_max)
+        in_leg_max = st.number_input(
+            label='Legend Max', value=100.0, step=10.0, disabled=disable_min_max)
+        in_seg_count = st.number_input(
+            label='Legend Segments', value=11, step=1)
+        st.form_submit_button(label='Apply')
     if in_leg_min != st.session_state.legend_min:
         st.session_state.legend_min = in_leg_min
-        new_sky_matrix()
-    in_leg_max = st.sidebar.number_input(
-        label='Legend Max', value=100.0, step=10.0, disabled=disable_min_max)
+        new_legend()
     if in_leg_max != st.session_state.legend_max:
         st.session_state.legend_max = in_leg_max
-        new_sky_matrix()
-    in_seg_count = st.sidebar.number_input(
-        label='Legend Segments', value=11, step=1)
+        new_legend()
     if in_seg_count != st.session_state.legend_seg_count:
         st.session_state.legend_seg_count = in_seg_count
-        new_sky_matrix()
+        new_legend()
@@ -1,6 +1,7 @@
 """Functions for processing outputs."""
 import os
 import pathlib
+import numpy as np
 import streamlit as st
 
 from ladybug_geometry.geometry3d import Point3D, Plane
@@ -19,17 +20,61 @@ from pollination_streamlit_viewer import viewer
 
 def report_total_radiation(rad_values, container, avg_irr, unit_conv=1):
     """Report the total radiation across all of the simulation geometry."""
-    face_areas = st.session_state.simulation_geo.face_areas
-    total = 0
-    for rad, area in zip(rad_values, face_areas):
-        total += rad * area * unit_conv
+    state = st.session_state
+    if state.face_areas is None:
+        state.face_areas = np.array(state.simulation_geo.face_areas, dtype=np.float64)
+    face_areas = state.face_areas
+    rad_values = np.asarray(rad_values, dtype=np.float64)
+    total = float(rad_values @ face_areas) * unit_conv
     if avg_irr:
-        tot_area = sum(face_areas) * unit_conv
+        tot_area = float(face_areas.sum()) * unit_conv
         container.header('Average Irradiance: {:,.1f} W/m2'.format(total / tot_area))
     else:
         container.header('Total Radiation: {:,.0f} kWh'.format(total))
 
 
+def legend_range(rad_values):
+    """Get the minimum and maximum of the legend for a list of radiation values."""
+    state = st.session_state
+    if state.override_min_max:
+        return state.legend_min, state.legend_max
+    rad_array = np.asarray(rad_values, dtype=np.float64)
+    min_val, max_val = float(rad_array.min()), float(rad_array.max())
+    if state.use_benefit:  # center the legend on zero
+        extrema = max(abs(min_val), max_val)
+        return -extrema, extrema
+    return min_val, max_val
+
+
+def results_visualization(rad_values, avg_irr):
+    """Get a VisualizationSet for the radiation values with the legend settings.
+
+    The VisualizationSet is stored in session state such that it is only rebuilt
+    when the results or the legend settings change.
+    """
+    state = st.session_state
+    if state.viz_set is not None:
+        return state.viz_set
+    d_type = Irradiance('Incident Irradiance') if avg_irr \
+        else Radiation('Incident Radiation')
+    unit = 'W/m2' if avg_irr else 'kWh/m2'
+    min_val, max_val = legend_range(rad_values)
+    color_set = reversed(Colorset.benefit_harm()) \
+        if state.use_benefit else Colorset.original()
+    l_par = LegendParameters(
+        min=min_val, max=max_val, title=unit,
+        segment_count=state.legend_seg_count,
+        base_plane=Plane(o=Point3D(10, 50, 0)))
+    l_par.decimal_count = 1
+    l_par.colors = color_set
+    viz_data = VisualizationData(
+        rad_values, l_par, data_type=d_type, unit=unit)
+    a_geo = AnalysisGeometry(
+        'Analysis_Geometry', [state.simulation_geo], [viz_data])
+    state.viz_set = VisualizationSet('Radiation_Study', [a_geo])
+    return state.viz_set
+
+
 def display_results(host, target_folder, user_id, rad_values, avg_irr, container):
     """Create the visualization of the radiation results.
 
@@ -43,32 +88,10 @@ def display_results(host, target_folder, user_id, rad_values, avg_irr, container
             of irradiance in W/m2.
         container: The streamlit container to which the viewer will be added.
     """
+    state = st.session_state
     # create the visualization set object with the results if there are values
     if rad_values:
-        d_type = Irradiance('Incident Irradiance') if avg_irr \
-            else Radiation('Incident Radiation')
-        unit = 'W/m2' if avg_irr else 'kWh/m2'
-        if st.session_state.override_min_max:
-            min_val = st.session_state.legend_min
-            max_val = st.session_state.legend_max
-        elif st.session_state.use_benefit:
-            extrema = max(abs(min(rad_values)), max(rad_values))
-            min_val, max_val = -extrema, extrema
-        else:
-            min_val, max_val = min(rad_values), max(rad_values)
-        color_set = reversed(Colorset.benefit_harm()) \
-            if st.session_state.use_benefit else Colorset.original()
-        l_par = LegendParameters(
-            min=min_val, max=max_val, title=unit,
-            segment_count=st.session_state.legend_seg_count,
-            base_plane=Plane(o=Point3D(10, 50, 0)))
-        l_par.decimal_count = 1
-        l_par.colors = color_set
-        viz_data = VisualizationData(
-            rad_values, l_par, data_type=d_type, unit=unit)
-        a_geo = AnalysisGeometry(
-            'Analysis_Geometry', [st.session_state.simulation_geo], [viz_data])
-        viz_set = VisualizationSet('Radiation_Study', [a_geo])
+        viz_set = results_visualization(rad_values, avg_irr)
 
     # send the results to the CAD environment if applicable
     in_ap_display = False
@@ -92,39 +115,39 @@ def display_results(host, target_folder, user_id, rad_values, avg_irr, container
             with container:
                 send_results(results=viz_set.to_dict(), key='rad-grids',
                              option='subscribe-preview', options=options)
-                u_conv = conversion_factor_to_meters(st.session_state.unit_system) ** 2
+                u_conv = conversion_factor_to_meters(state.unit_system) ** 2
                 report_total_radiation(rad_values, container, avg_irr, u_conv)
 
     # draw the VTK visualization
     if host == 'web' or in_ap_display:  # write the radiation values to files
         if not rad_values:
             return
-        # if the visualization set is displaying in the viewer, add the context
-        if st.session_state.context_geo is not None:
-            geo_obj = []
-            for face3d in st.session_state.context_geo:
-                for seg in face3d.boundary_segments:
-                    geo_obj.append(seg)
-                if face3d.has_holes:
-                    for hole in face3d.hole_segments:
-                        geo_obj.extend(hole)
-            con_geo = ContextGeometry('ContextShade', geo_obj)
-            con_geo.display_name = 'Context Shade'
-            viz_set.add_geometry(con_geo)
         # report the total radiation (or average irradiance)
-        hb_model = st.session_state.hb_model
+        hb_model = state.hb_model
         unit_conv = conversion_factor_to_meters(hb_model.units) ** 2 \
             if hb_model is not None else \
-            conversion_factor_to_meters(st.session_state.unit_system) ** 2
+            conversion_factor_to_meters(state.unit_system) ** 2
         report_total_radiation(rad_values, container, avg_irr, unit_conv)
         # display the results in the 3D viewer
-        if st.session_state.vtk_path is None:
+        if state.vtk_bytes is None:
+            # if the visualization set is displaying in the viewer, add the context
+            if state.context_geo is not None:
+                geo_obj = []
+                for face3d in state.context_geo:
+                    for seg in face3d.boundary_segments:
+                        geo_obj.append(seg)
+                    if face3d.has_holes:
+                        for hole in face3d.hole_segments:
+                            geo_obj.extend(hole)
+                con_geo = ContextGeometry('ContextShade', geo_obj)
+                con_geo.display_name = 'Context Shade'
+                viz_set = VisualizationSet(
+                    viz_set.identifier, list(viz_set.geometry) + [con_geo])
             result_folder = os.path.join(target_folder, 'data', user_id)
             if not os.path.isdir(result_folder):
                 os.makedirs(result_folder)
             vtk_vs = VTKVisualizationSet.from_visualization_set(viz_set)
-            st.session_state.vtk_path = vtk_vs.to_vtkjs(
-                folder=result_folder, name='vis_set')
-        vtk_path = st.session_state.vtk_path
+            vtk_path = vtk_vs.to_vtkjs(folder=result_folder, name='vis_set')
+            state.vtk_bytes = pathlib.Path(vtk_path).read_bytes()
         with container:
-            viewer(content=pathlib.Path(vtk_path).read_bytes(), key='vtk_res_model')
+            viewer(content=state.vtk_bytes, key='vtk_res_model')
@@ -1,50 +1,65 @@
 """Run a ray tracing simulation with Radiance and compute incident radiation."""
 import math
+from pathlib import Path
+import numpy as np
 import streamlit as st
 
 from ladybug.viewsphere import view_sphere
 from ladybug_radiance.skymatrix import SkyMatrix
 from ladybug_radiance.intersection import intersection_matrix
 
+from cache import cache_file_path, read_cache, write_cache
 
+
+@st.experimental_memo(show_spinner=False, max_entries=8)
 def compute_sky_matrix(
-        sky_file_path, run_period, north, high_sky_density, ground_reflectance,
-        avg_irr, use_benefit, bal_temp):
-    """Compute the sky matrix from an input weather file and run period."""
+        sky_file_id, _sky_file_path, hoys, north, high_sky_density,
+        ground_reflectance, avg_irr, use_benefit, bal_temp):
+    """Compute the sky matrix from an input weather file and the hoys of a run period.
+
+    The result is cached using the sky_file_id and the other inputs such that
+    the sky is only recomputed when the weather file or sky settings change.
+    """
     # create the sky matrix from the files
-    hoys = None if len(run_period) == 8760 else run_period.hoys
-    if sky_file_path.name.endswith('.epw'):
+    if _sky_file_path.name.endswith('.epw'):
         if use_benefit:
             sky_matrix = SkyMatrix.from_epw_benefit(
-                str(sky_file_path), bal_temp, 2, hoys,
+                str(_sky_file_path), bal_temp, 2, hoys,
                 north, high_sky_density, ground_reflectance)
         else:
             sky_matrix = SkyMatrix.from_epw(
-                str(sky_file_path), hoys, north, high_sky_density, ground_reflectance)
-    elif sky_file_path.name.endswith('.stat'):
+                str(_sky_file_path), hoys, north, high_sky_density, ground_reflectance)
+    elif _sky_file_path.name.endswith('.stat'):
         sky_matrix = SkyMatrix.from_stat(
-            str(sky_file_path), hoys, north, high_sky_density, ground_reflectance)
+            str(_sky_file_path), hoys, north, high_sky_density, ground_reflectance)
     else:
         msg = 'Unrecognized file: {}.\nMust have an .epw extension or ' \
-            'a .stat extension.'.format(sky_file_path)
+            'a .stat extension.'.format(_sky_file_path)
         raise ValueError(msg)
-    # get the direct and diffuse radiation values
-    dir_vals, diff_vals = sky_matrix.direct_values, sky_matrix.diffuse_values
+    # get the total radiation values of the sky patches
+    total_sky_rad = np.add(sky_matrix.direct_values, sky_matrix.diffuse_values)
     if avg_irr:  # compute the radiation values into irradiance
-        conversion = 1000 / sky_matrix.wea_duration
-        dir_vals = tuple(v * conversion for v in dir_vals)
-        diff_vals = tuple(v * conversion for v in diff_vals)
-    # return the session state variable for the sky sphere values
-    total_sky_rad = [dir_rad + dif_rad for dir_rad, dif_rad in zip(dir_vals, diff_vals)]
-    ground_value = (sum(total_sky_rad) / len(total_sky_rad)) * ground_reflectance
-    ground_rad = [ground_value] * len(total_sky_rad)
-    return total_sky_rad + ground_rad
+        total_sky_rad *= 1000 / sky_matrix.wea_duration
+    # return the sky patch values and the single value shared by all ground patches
+    ground_value = float(total_sky_rad.mean()) * ground_reflectance
+    return total_sky_rad.astype(np.float32), ground_value
 
 
+@st.experimental_singleton(show_spinner=False, max_entries=4)
 def compute_intersection_matrix(
-        study_mesh, context_geo, offset_dist, north, high_res):
+        geometry_id, _study_mesh, _context_geo, offset_dist, north, high_res,
+        _cache_file):
     """Compute the intersection matrix between the points of a study_mesh and sky dome.
+
+    The result is cached using the geometry_id of the study mesh and context
+    along with the other inputs such that the ray tracing is only run once for
+    the same geometry and settings across all sessions. The matrix is also
+    saved to the _cache_file such that it is reused after the app restarts.
     """
+    # load the matrix from a previous run if it exists and is readable
+    int_mtx = read_cache(_cache_file, lambda path: np.load(path, mmap_mode='r'))
+    if int_mtx is not None:
+        return int_mtx
     # process the sky into an acceptable format
     lb_vecs = view_sphere.reinhart_dome_vectors if high_res \
         else view_sphere.tregenza_dome_vectors
@@ -53,10 +68,24 @@ def compute_intersection_matrix(
         lb_vecs = tuple(vec.rotate_xy(north_angle) for vec in lb_vecs)
     lb_grnd_vecs = tuple(vec.reverse() for vec in lb_vecs)
     vectors = lb_vecs + lb_grnd_vecs
-    # compute the intersection matrix
-    return intersection_matrix(
-        vectors, study_mesh.face_centroids, study_mesh.face_normals, context_geo,
+    # compute the intersection matrix as an array with a row for each point
+    int_mtx = intersection_matrix(
+        vectors, _study_mesh.face_centroids, _study_mesh.face_normals, _context_geo,
         offset_dist, True)
+    int_mtx = np.asarray(int_mtx, dtype=np.float32)
+    int_mtx.flags.writeable = False  # the array is shared between sessions
+    # write the matrix to the cache for use after the app restarts
+    write_cache(_cache_file, lambda cache_out: np.save(cache_out, int_mtx))
+    return int_mtx
+
+
+def _intersection_cache_file(
+        target_folder, geometry_id, offset_dist, north, high_res):
+    """Get the path to the file where an intersection matrix is cached."""
+    mtx_key = repr([str(g_id) for g_id in geometry_id] +
+                   [round(float(offset_dist), 6), round(float(north), 6), high_res])
+    cache_folder = Path(target_folder, 'data', 'intersection')
+    return cache_file_path(cache_folder, 'int', '.npy', mtx_key, ('ladybug-radiance',))
 
 
 def run_simulation(
@@ -65,6 +94,7 @@ def run_simulation(
     ground_reflectance, north
 ):
     """Run a simulation to get incident radiation."""
+    state = st.session_state
     button_holder = st.empty()
     run_help = 'Check to have the radiation calculation automatically re-run every ' \
         'time one of the inputs is changed. This option should only be used for ' \
@@ -72,28 +102,34 @@ def run_simulation(
     auto_rerun = st.checkbox(label='Automatic Re-run', value=False, help=run_help)
     # check to be sure there is a model
     if not sky_file_path or not study_mesh or not context_geo or \
-            st.session_state.radiation_values is not None:
+            state.radiation_values is not None:
         return
 
     # simulate the model if the button is pressed
     if auto_rerun or button_holder.button('Compute Radiation'):
         # get the values for the radiation of the view sphere
-        if st.session_state.sky_matrix is None:
-            st.session_state.sky_matrix = compute_sky_matrix(
-                sky_file_path, run_period, north, high_sky_density, ground_reflectance,
-                avg_irr, use_benefit, bal_temp)
-        sky_mtx = st.session_state.sky_matrix
+        if state.sky_matrix is None:
+            hoys = None if len(run_period) == 8760 else run_period.hoys
+            state.sky_matrix = compute_sky_matrix(
+                state.weather_file_id, sky_file_path, hoys, north,
+                high_sky_density, ground_reflectance, avg_irr, use_benefit, bal_temp)
+        sky_rad, ground_value = state.sky_matrix
 
         # get the intersection matrix if it does not already exist
-        if st.session_state.intersection_matrix is None:
-            high_res = False if len(sky_mtx) == 290 else True
-            st.session_state.intersection_matrix = compute_intersection_matrix(
-                study_mesh, context_geo, offset_dist, north, high_res)
-        int_mtx = st.session_state.intersection_matrix
+        if state.intersection_matrix is None:
+            geometry_id = \
+                (state.model_hash, state.geometry_cache_file, state.context_hash)
+            cache_file = _intersection_cache_file(
+                target_folder, geometry_id, offset_dist, north, high_sky_density)
+            state.intersection_matrix = compute_intersection_matrix(
+                geometry_id, study_mesh, context_geo, offset_dist, north,
+                high_sky_density, cache_file)
+        int_mtx = state.intersection_matrix
+        if state.int_ground_sum is None:  # all ground patches share one value
+            state.int_ground_sum = int_mtx[:, len(sky_rad):].sum(axis=1)
 
         # multiply the sky matrix by the intersection matrix
-        st.session_state.radiation_values = [
-            sum(r * w for r, w in zip(pt_rel, sky_mtx))
-            for pt_rel in int_mtx
-        ]
+        rad_values = int_mtx[:, :len(sky_rad)] @ sky_rad
+        rad_values += ground_value * state.int_ground_sum
+        state.radiation_values = rad_values.tolist()
         button_holder.write('')